@@ -22,18 +22,28 @@
 
 """Produce a Getting Things Done next actions list from org files"""
 
+from collections import namedtuple
 from datetime import datetime
-import shutil
+from stat import S_ISREG
 from typing import Optional
-from functools import reduce
+from functools import partial
+import io
+from itertools import chain
 import os
+import re
+import sys
 import argparse
 import random
-import yaml
-import sqlite3
-import tempfile
 
-import orgparse
+# Third-party and rarely needed modules are imported where they are used,
+# to keep start-up fast: --create, for instance, needs none of them.
+
+# Terminal escape sequences for output colours
+BOLD_WHITE = "\033[97;1m"
+BOLD_RED = "\033[91;1m"
+RESET = "\033[0m"
+ARROW = "\033[32;1m    ⤷  "
+NO_ACTIONS = "⚠  No next actions!"
 
 
 def main():
@@ -63,6 +73,11 @@ def main():
         action="store_true",
         help="only show date and project and action counts"
     )
+    parser.add_argument(
+        "--orgparse",
+        action="store_true",
+        help="read project files with orgparse rather than the fast scanner",
+    )
     parser.add_argument(
         "tag",
         type=str,
@@ -80,39 +95,41 @@ def main():
 def print_project_list(args):
     config = read_config("~/.gtd")
     sources = map(expand_path, config["projects"])
-    project_list = ProjectList(sources)
+    project_list = ProjectList(sources, ActionCache(CACHE_PATH, args.orgparse))
+    n_actions, _ = project_list.stats()
     if args.count:
         print(f"{datetime.now().strftime('%Y-%m-%d')} "
-              f"{len(project_list.projects)} {project_list.n_actions()}")
+              f"{len(project_list.projects)} {n_actions}")
     else:
         project_list.print(args.randomize, args.tag, not args.projects)
         print()
         print(f"{len(project_list.projects)} projects")
-        print(f"{project_list.n_actions()} next actions")
+        print(f"{n_actions} next actions")
         print_warnings(project_list, config)
 
 
 def print_warnings(project_list, config):
-    n_actionless_projects = len(project_list.get_actionless_projects())
+    _, actionless_projects = project_list.stats()
+    n_actionless_projects = len(actionless_projects)
     if n_actionless_projects > 0:
         print(
-            f"\033[91;1m{plural(n_actionless_projects, 'project')} "
-            f"without next actions\033[0m"
+            f"{BOLD_RED}{plural(n_actionless_projects, 'project')} "
+            f"without next actions{RESET}"
         )
     inboxes = map(expand_path, config["inboxes"])
     inboxes_empty = True
     for inbox in inboxes:
-        contents = os.listdir(inbox)
-        n_items = len(contents)
+        with os.scandir(inbox) as entries:
+            n_items = sum(1 for _ in entries)
         if n_items > 0:
             inboxes_empty = False
-            print(f"\033[91;1m{plural(n_items, 'item')} in {inbox}\033[0m")
+            print(f"{BOLD_RED}{plural(n_items, 'item')} in {inbox}{RESET}")
     if config["bookmarks"]:
         n_bookmarks = count_firefox_bookmarks(expand_path(config["bookmarks"]))
         if n_bookmarks > 0:
             print(
-                f"\033[91;1m{plural(n_bookmarks, 'bookmark')} "
-                f"on toolbar\033[0m"
+                f"{BOLD_RED}{plural(n_bookmarks, 'bookmark')} "
+                f"on toolbar{RESET}"
             )
             inboxes_empty = False
     if inboxes_empty:
@@ -124,8 +141,12 @@ def plural(n: int, name: str) -> str:
 
 
 def read_config(path: str) -> dict:
+    import yaml
+
     with open(expand_path(path), "r") as fh:
-        config = yaml.safe_load(fh)
+        # Use the libyaml bindings if PyYAML was built with them.
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+        config = yaml.load(fh, Loader=loader)
     return config
 
 
@@ -145,31 +166,387 @@ def create_project_directory(path: str) -> None:
 
 
 def count_firefox_bookmarks(db_path) -> int:
-    with tempfile.TemporaryDirectory() as tempdir:
-        db_temp_path = os.path.join(tempdir, "places.sqlite")
-        # Firefox locks the database so we work from a copy
-        shutil.copy2(db_path, db_temp_path)
-        db = sqlite3.connect("file:" + db_temp_path + "?mode=ro", uri=True)
-        cursor = db.cursor()
-        cursor.execute("SELECT id FROM moz_bookmarks WHERE title='toolbar'")
-        toolbar_id = list(cursor)[0][0]
-        cursor.execute(
-            f"SELECT title FROM moz_bookmarks WHERE parent={toolbar_id}"
+    import pathlib
+    import sqlite3
+
+    # Firefox locks the database. Rather than working from a copy, we open it
+    # as immutable, which makes sqlite skip locking entirely. Like a copy of
+    # the main file, this doesn't see changes still in the write-ahead log.
+    db_uri = pathlib.Path(db_path).resolve().as_uri() + "?immutable=1"
+    db = sqlite3.connect(db_uri, uri=True)
+    try:
+        # The database is only read once, so let sqlite map it into memory
+        # rather than filling its page cache.
+        db.execute("PRAGMA query_only=1")
+        db.execute("PRAGMA mmap_size=67108864")
+        cursor = db.execute(
+            "SELECT COUNT(*) FROM moz_bookmarks WHERE parent="
+            "(SELECT id FROM moz_bookmarks WHERE title='toolbar')"
+        )
+        return cursor.fetchone()[0]
+    finally:
+        db.close()
+
+
+CACHE_PATH = "~/.cache/gtd/index.sqlite"
+# Increment when the cache schema, the stored Action format or the parsers'
+# results change, so that existing caches are discarded rather than misread.
+CACHE_VERSION = 4
+
+# Below this number of files to parse, starting worker processes costs more
+# than parsing serially.
+MIN_PARALLEL_PARSE = 4
+
+# Only the raw heading and tags of an action are ever used, so we keep these
+# rather than the orgparse node, which lets the parsed tree be freed. The
+# tags are a frozenset, since orgparse recomputes inherited tags on each
+# access.
+Action = namedtuple("Action", "heading tags")
+
+
+class ActionCache:
+    """Next actions read from project org files, stored between runs
+
+    Entries are keyed on the file path and the parser used, and are discarded
+    when the file's modification time or size changes. The cache also
+    decides which parser reads the files. It only saves time: with no path,
+    or if its database can't be opened, every lookup misses and nothing is
+    stored.
+    """
+
+    def __init__(self, path: Optional[str], use_orgparse: bool = False):
+        import sqlite3
+
+        self.use_orgparse = use_orgparse
+        self.parser = "orgparse" if use_orgparse else "scanner"
+        self.db = None
+        if path is None:
+            return
+        path = expand_path(path)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                self.db = self._open(path)
+            except sqlite3.OperationalError:
+                # E.g. locked or read-only; handled below.
+                raise
+            except sqlite3.DatabaseError:
+                # The file is not a usable database, so start a new one.
+                os.remove(path)
+                self.db = self._open(path)
+        except (OSError, sqlite3.Error):
+            self.db = None
+
+    @staticmethod
+    def _open(path: str):
+        import sqlite3
+
+        db = sqlite3.connect(path)
+        try:
+            version = db.execute("PRAGMA user_version").fetchone()[0]
+            if version != CACHE_VERSION:
+                db.execute("DROP TABLE IF EXISTS actions")
+                db.execute(
+                    "CREATE TABLE actions ("
+                    "path TEXT, parser TEXT, mtime INTEGER, size INTEGER, "
+                    "actions BLOB, PRIMARY KEY (path, parser))"
+                )
+                db.execute(f"PRAGMA user_version={CACHE_VERSION}")
+        except sqlite3.Error:
+            db.close()
+            raise
+        return db
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[list]:
+        import pickle
+        import sqlite3
+
+        if self.db is None:
+            return None
+        try:
+            row = self.db.execute(
+                "SELECT actions FROM actions "
+                "WHERE path=? AND parser=? AND mtime=? AND size=?",
+                (path, self.parser, stat.st_mtime_ns, stat.st_size),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        # Stored as plain tuples so that the pickle doesn't depend on the
+        # module name under which Action was defined.
+        return [Action._make(action) for action in pickle.loads(row[0])]
+
+    def put(self, entries: list) -> None:
+        """Store (path, stat, actions) entries in a single transaction"""
+        import pickle
+        import sqlite3
+
+        if self.db is None or not entries:
+            return
+        rows = [
+            (
+                path,
+                self.parser,
+                stat.st_mtime_ns,
+                stat.st_size,
+                pickle.dumps([tuple(action) for action in actions]),
+            )
+            for path, stat, actions in entries
+        ]
+        try:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO actions VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+        except sqlite3.Error:
+            # E.g. a read-only cache: the files will be parsed again next run.
+            pass
+
+    def load(self, paths: list) -> dict:
+        """Return the next actions in each of the given org files
+
+        Each file is looked up once; files with stale entries are parsed.
+        The files are independent, so when there are enough of them they are
+        parsed in a pool of worker processes. Only the resulting actions are
+        sent back, since orgparse nodes are costly to pickle. The new entries
+        are stored in one transaction. Paths which are not regular files are
+        left out of the result.
+        """
+        import concurrent.futures
+
+        actions_by_path = {}
+        stale = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not S_ISREG(stat.st_mode):
+                continue
+            actions = self.get(path, stat)
+            if actions is None:
+                stale.append((path, stat))
+            else:
+                actions_by_path[path] = actions
+        stale_paths = [path for path, _ in stale]
+        read = partial(read_actions, use_orgparse=self.use_orgparse)
+        executor = None
+        if len(stale) >= MIN_PARALLEL_PARSE:
+            try:
+                executor = concurrent.futures.ProcessPoolExecutor()
+            except (OSError, NotImplementedError):
+                # No working POSIX semaphores (e.g. on Termux), so no pool.
+                pass
+        if executor is None:
+            results = list(map(read, stale_paths))
+        else:
+            with executor:
+                results = list(executor.map(read, stale_paths, chunksize=4))
+        actions_by_path.update(zip(stale_paths, results))
+        self.put(
+            [
+                (path, stat, actions)
+                for (path, stat), actions in zip(stale, results)
+            ]
+        )
+        return actions_by_path
+
+
+# The scanner below follows orgparse's rules for headings: a heading line
+# has a space after its stars, and tags, then a TODO keyword, then a
+# priority cookie are parsed off the heading text in that order.
+HEADING_LINE_RE = re.compile(r"^(\*+) (.*)$", re.MULTILINE)
+HEADING_TAGS_RE = re.compile(r"(.*?)\s*:([\w@:]+):\s*$")
+PRIORITY_RE = re.compile(r"^\s*\[#[A-Z0-9]\] ?(.*)$")
+# An org link, as matched by orgparse when converting to plain text
+LINK_RE = re.compile(r"\[\[([^\]]+)\]\]|\[\[[^\]]+\]\[([^\]]+)\]\]")
+SETTING_RE = re.compile(r"^[ \t]*#\+([^:\n]*):(.*)$", re.MULTILINE)
+TODO_SETTINGS = ("TODO", "SEQ_TODO", "TYP_TODO")
+
+
+def read_actions(path: str, use_orgparse: bool = False) -> list:
+    if use_orgparse:
+        import orgparse
+
+        # orgparse.loads would also split lines at form feeds and other
+        # Unicode line boundaries; a file object splits only at newlines, as
+        # orgparse.load does when reading the file itself.
+        root = orgparse.load(io.StringIO(read_actions_section(path)))
+        return Project._find_actions(root)
+    return scan_actions(path)
+
+
+def read_actions_section(path: str) -> str:
+    """Read only the parts of an org file needed to find its actions
+
+    These are the text before the first heading, the in-buffer settings
+    elsewhere in the file (which may declare TODO keywords), and the
+    top-level "Actions" section. Notes and archives elsewhere in the file
+    are not passed to orgparse. FILETAGS settings only apply before the
+    first heading, so any outside it are left out.
+    """
+    with open(path, "r", encoding="utf-8") as fh:
+        text = fh.read()
+    first_heading = HEADING_LINE_RE.search(text)
+    if first_heading is None:
+        return text
+    preamble_end = first_heading.start()
+    section = find_actions_section(text, read_todo_keywords(text))
+    if section is None:
+        return text[:preamble_end]
+    start, end, _ = section
+    settings = [
+        setting_match.group(0) + "\n"
+        for setting_match in chain(
+            SETTING_RE.finditer(text, preamble_end, start),
+            SETTING_RE.finditer(text, end),
         )
-        # We don't use the titles at present, but might want them one day
-        return len(list(cursor))
+        if setting_match.group(1).upper() != "FILETAGS"
+    ]
+    return text[:preamble_end] + "".join(settings) + text[start:end]
+
+
+def scan_actions(path: str) -> list:
+    """Find the next actions in a project file without a full org parse
+
+    Only the "* Actions" section is examined, so this handles project files
+    of the usual layout much faster than orgparse, while giving the same
+    results.
+    """
+    with open(path, "r", encoding="utf-8") as fh:
+        text = fh.read()
+    todo_keywords = read_todo_keywords(text)
+    if "NEXT" not in todo_keywords:
+        return []
+    section = find_actions_section(text, todo_keywords)
+    if section is None:
+        return []
+    start, end, section_tags = section
+    # Actions inherit tags from the "Actions" heading and from any FILETAGS
+    # settings before the first heading.
+    inherited_tags = set(section_tags)
+    first_heading = HEADING_LINE_RE.search(text)
+    for key, value in SETTING_RE.findall(text[:first_heading.start()]):
+        if key.upper() == "FILETAGS":
+            inherited_tags.update(_split_tags(value))
+    actions = []
+    headings = HEADING_LINE_RE.finditer(text, start, end)
+    next(headings)  # the "Actions" heading itself
+    # A heading is a child of "Actions" unless it is nested under an
+    # earlier, shallower heading in the section.
+    child_level = None
+    for heading_match in headings:
+        level = len(heading_match.group(1))
+        if child_level is not None and level > child_level:
+            continue
+        child_level = level
+        todo, heading, tags = parse_heading(
+            heading_match.group(2), todo_keywords
+        )
+        if todo == "NEXT":
+            actions.append(
+                Action(heading, frozenset(inherited_tags.union(tags)))
+            )
+    return actions
+
+
+def read_todo_keywords(text: str) -> list:
+    """Return the TODO keywords in effect in the text of an org file
+
+    As in orgparse, settings anywhere in the file count, and any setting
+    replaces the default TODO and DONE keywords.
+    """
+    declared = False
+    todos = []
+    dones = []
+    for key, value in SETTING_RE.findall(text):
+        if key.upper() in TODO_SETTINGS:
+            declared = True
+            todo_part, _, done_part = value.partition("|")
+            # Fast access keys, as in "NEXT(n)", are not part of the keyword.
+            todos.extend(word.split("(", 1)[0] for word in todo_part.split())
+            dones.extend(word.split("(", 1)[0] for word in done_part.split())
+    return todos + dones if declared else ["TODO", "DONE"]
+
+
+def find_actions_section(text: str, todo_keywords: list) -> Optional[tuple]:
+    """Locate the first top-level "Actions" heading in the text of an org file
+
+    Returns the start and end offsets of the heading's section, up to the
+    next top-level heading, and the heading's tags; or None if there is no
+    such heading. As in orgparse, a top-level heading is one not nested
+    under an earlier, shallower heading, whatever its own level.
+    """
+    start = None
+    section_tags = []
+    top_level = None
+    for heading_match in HEADING_LINE_RE.finditer(text):
+        level = len(heading_match.group(1))
+        if top_level is not None and level > top_level:
+            continue
+        top_level = level
+        if start is not None:
+            return start, heading_match.start(), section_tags
+        _, heading, tags = parse_heading(heading_match.group(2), todo_keywords)
+        if to_plain_text(heading) == "Actions":
+            start = heading_match.start()
+            section_tags = tags
+    return None if start is None else (start, len(text), section_tags)
+
+
+def to_plain_text(text: str) -> str:
+    """Replace org links with their descriptions, as orgparse does"""
+    return LINK_RE.sub(lambda m: m.group(1) or m.group(2), text)
+
+
+def parse_heading(text: str, todo_keywords: list) -> tuple:
+    """Split heading text after the stars into TODO keyword, heading and tags
+
+    The heading is returned in orgparse's raw format, without the TODO
+    keyword, priority cookie or tags.
+    """
+    heading = text.strip()
+    tags = []
+    tags_match = HEADING_TAGS_RE.search(heading)
+    if tags_match is not None:
+        heading = tags_match.group(1)
+        tags = tags_match.group(2).split(":")
+    todo = None
+    for keyword in todo_keywords:
+        if heading == keyword:
+            heading, todo = "", keyword
+            break
+        if heading.startswith(keyword + " "):
+            heading, todo = heading[len(keyword) + 1:], keyword
+            break
+    priority_match = PRIORITY_RE.search(heading)
+    if priority_match is not None:
+        heading = priority_match.group(1)
+    return todo, heading, tags
+
+
+def _split_tags(tags: Optional[str]) -> list:
+    return [tag.strip() for tag in tags.split(":") if tag.strip()] \
+        if tags else []
 
 
 class Project:
 
-    def __init__(self, node_or_path):
+    def __init__(
+        self,
+        node_or_path,
+        actions: Optional[list] = None,
+    ):
         self.actions = []
         if isinstance(node_or_path, str):
             self.name = os.path.splitext(os.path.basename(node_or_path))[0] \
                 + " \U0001F5C0"
-            if os.path.isfile(node_or_path):
-                node = orgparse.load(node_or_path)
-                self.actions = self._find_actions(node)
+            # Project files are parsed by ActionCache.load, which leaves out
+            # paths that aren't regular files.
+            if actions is not None:
+                self.actions = actions
         else:
             node = node_or_path
             self.name = node.get_heading(format="raw") + " ∗"
@@ -177,54 +554,73 @@ class Project:
 
     @staticmethod
     def _find_actions(node):
-        for child in node.children:
-            if child.heading == "Actions":
-                return list(filter(lambda n: n.todo == "NEXT", child.children))
-        return []
-
-    def print(self, tag: Optional[str] = None, with_actions: bool = True):
+        # The plain heading is compared, so that a link whose description
+        # is "Actions" also counts.
+        actions_node = next(
+            (child for child in node.children if child.heading == "Actions"),
+            None,
+        )
+        if actions_node is None:
+            return []
+        return [
+            Action(n.get_heading(format="raw"), frozenset(n.tags))
+            for n in actions_node.children
+            if n.todo == "NEXT"
+        ]
+
+    def format_lines(
+        self, tag: Optional[str] = None, with_actions: bool = True
+    ) -> list:
+        lines = []
         if with_actions:
-            print(f"\033[97;1m" + self.name + "\033[0m")
+            lines.append(f"{BOLD_WHITE}{self.name}{RESET}")
             if self.actions:
-                for action in self.actions:
-                    if tag is None or tag in action.tags:
-                        print(
-                            "\033[32;1m    ⤷  "
-                            + action.get_heading(format="raw")
-                            + "\033[0m"
-                        )
+                for heading, tags in self.actions:
+                    if tag is None or tag in tags:
+                        lines.append(f"{ARROW}{heading}{RESET}")
             else:
-                print("\033[91;1m    ⚠  No next actions!\033[0m")
+                lines.append(f"{BOLD_RED}    {NO_ACTIONS}{RESET}")
+        elif self.actions:
+            lines.append(self.name)
         else:
-            print(
-                self.name
-                + (
-                    ""
-                    if self.actions
-                    else " \033[91;1m⚠  No next actions!\033[0m"
-                )
-            )
+            lines.append(f"{self.name} {BOLD_RED}{NO_ACTIONS}{RESET}")
+        return lines
 
 
 class ProjectList:
 
-    def __init__(self, paths):
+    def __init__(
+        self,
+        paths,
+        cache: Optional[ActionCache] = None,
+    ):
         self.projects = []
+        # Project files are always read through the cache, which holds the
+        # choice of parser; without a cache path it stores nothing.
+        self.cache = ActionCache(None) if cache is None else cache
+        self._stats = None
         for path in paths:
             if os.path.isdir(path):
                 self.scan_directory(path)
             else:
                 self.scan_project_list(path)
 
-    def n_actions(self):
-        return reduce(
-            lambda total, project: total + len(project.actions),
-            self.projects,
-            0,
-        )
-
-    def get_actionless_projects(self):
-        return list(filter(lambda p: len(p.actions) == 0, self.projects))
+    def stats(self) -> tuple:
+        """Return the total number of actions and the actionless projects
+
+        Both are computed in a single pass over the projects, and cached,
+        since the list is complete once it has been constructed.
+        """
+        if self._stats is None:
+            n_actions = 0
+            actionless_projects = []
+            for project in self.projects:
+                n = len(project.actions)
+                n_actions += n
+                if n == 0:
+                    actionless_projects.append(project)
+            self._stats = n_actions, actionless_projects
+        return self._stats
 
     def print(
         self,
@@ -232,15 +628,18 @@ class ProjectList:
         tag: Optional[str] = None,
         with_actions: bool = True,
     ):
-        projects = (
-            random.sample(self.projects, len(self.projects))
-            if randomize
-            else self.projects
-        )
+        projects = self.projects[:]
+        if randomize:
+            random.shuffle(projects)
+        # Write the whole list at once rather than a line at a time.
+        lines = []
         for project in projects:
-            project.print(tag, with_actions)
+            lines.extend(project.format_lines(tag, with_actions))
+        sys.stdout.write("".join(line + "\n" for line in lines))
 
     def scan_project_list(self, path):
+        import orgparse
+
         root = orgparse.load(path)
         project_lists = root.children
         current_projects = project_lists[0]
@@ -249,33 +648,25 @@ class ProjectList:
         return len(current_projects.children)
 
     def scan_directory(self, root_path):
-        subdirs = list(
-            map(
-                lambda subdir: os.path.join(root_path, subdir),
-                filter(
-                    lambda entry: os.path.isdir(
-                        os.path.join(root_path, entry)
-                    ),
-                    os.listdir(root_path),
-                ),
+        # DirEntry.is_dir() uses the file type cached by the directory read,
+        # so we avoid a stat() call per entry.
+        with os.scandir(root_path) as entries:
+            org_filenames = sorted(
+                os.path.join(entry.path, entry.name + ".org")
+                for entry in entries
+                if entry.is_dir()
             )
-        )
-        org_filenames = sorted(
-            list(
-                map(
-                    lambda subdir: os.path.join(
-                        subdir, os.path.basename(subdir) + ".org"
-                    ),
-                    subdirs,
-                )
-            )
-        )
+        actions_by_path = self.cache.load(org_filenames)
         for org_filename in org_filenames:
-            self.scan_project_org_file(org_filename)
+            self.scan_project_org_file(
+                org_filename, actions_by_path.get(org_filename)
+            )
         return len(org_filenames)
 
-    def scan_project_org_file(self, filename: str):
-        self.projects.append(Project(filename))
+    def scan_project_org_file(
+        self, filename: str, actions: Optional[list] = None
+    ):
+        self.projects.append(Project(filename, actions))
 
 
 if __name__ == "__main__":